@@ -1,5 +1,5 @@
 import logging
-from .home_assistant_setup import get_or_create_long_token_sync
+from .home_assistant_setup import clear_cached_token, get_or_create_long_token_sync
 from .mcp_server import MCPHomeAssistantServer
 
 
@@ -21,5 +21,5 @@ def main() -> None:
             }
         }
     }
-    server = MCPHomeAssistantServer(config)
+    server = MCPHomeAssistantServer(config, on_auth_error=clear_cached_token)
     server.run()
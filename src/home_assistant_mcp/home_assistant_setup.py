@@ -5,15 +5,30 @@ from home_assistant_sdk import (
     MCPServerIntegration,
     HAAuthError,
 )
+from typing import Dict, Optional, Tuple
+import aiofiles
 import asyncio
 import logging
 import os
+import time
 
 home_assistant_username = os.getenv("HOME_ASSISTANT_USERNAME", "admin")
 home_assistant_password = os.getenv("HOME_ASSISTANT_PASSWORD", "admin123")
 home_assistant_url = os.getenv("HOME_ASSISTANT_URL", "http://127.0.0.1:8123")
 home_assistant_cache_dir = os.getenv("HOME_ASSISTANT_CACHE_DIR", "./.cache")
 
+# 缓存目录中的令牌文件和MCP集成标记文件
+TOKEN_FILE_NAME = "token.txt"
+INTEGRATION_FILE_NAME = "mcp_integration_setup.ok"
+
+# 等待配置条目订阅首次回调的超时时间（秒）
+CONFIG_ENTRIES_TIMEOUT = 2.0
+# 内存中令牌缓存的有效期（秒）
+TOKEN_CACHE_TTL = 3600.0
+
+# (URL, 用户名) -> (令牌, 获取时间)
+_token_cache: Dict[Tuple[str, str], Tuple[str, float]] = {}
+
 
 async def get_or_create_long_token():
     """
@@ -22,10 +37,11 @@ async def get_or_create_long_token():
     该函数执行以下操作：
     1. 确保缓存目录存在
     2. 尝试从缓存文件读取现有令牌，如果没有则通过认证获取
-    3. 建立WebSocket连接到Home Assistant
-    4. 如果没有缓存的MCP令牌，则删除旧的MCP令牌并创建新的
-    5. 检查是否已存在MCP服务器集成，如果没有则创建
-    6. 返回MCP长期访问令牌
+    3. 如果已缓存令牌且MCP集成已设置完成，直接返回缓存的令牌
+    4. 建立WebSocket连接到Home Assistant
+    5. 如果没有缓存的MCP令牌，则删除旧的MCP令牌并创建新的
+    6. 检查是否已存在MCP服务器集成，如果没有则创建；确认集成存在后写入标记文件
+    7. 返回MCP长期访问令牌
 
     Returns:
         str: MCP长期访问令牌
@@ -34,15 +50,24 @@ async def get_or_create_long_token():
         Exception: 当认证失败或WebSocket连接失败时抛出异常
     """
     # 确保缓存目录存在
-    if not os.path.exists(home_assistant_cache_dir):
+    if not await asyncio.to_thread(os.path.exists, home_assistant_cache_dir):
         logging.info(f"Cache dir not exists, create it: {home_assistant_cache_dir}")
-        os.mkdir(home_assistant_cache_dir)
+        await asyncio.to_thread(os.makedirs, home_assistant_cache_dir, exist_ok=True)
+
+    # 构建令牌文件和集成标记文件路径
+    token_file = os.path.join(home_assistant_cache_dir, TOKEN_FILE_NAME)
+    integration_file = os.path.join(home_assistant_cache_dir, INTEGRATION_FILE_NAME)
 
-    # 构建令牌文件路径
-    token_file = os.path.join(home_assistant_cache_dir, "token.txt")
+    # 读取缓存的MCP令牌（只读取一次，后续步骤复用）
+    cached_token = await _read_cached_token(token_file)
+
+    # 令牌已缓存且集成已设置完成，无需建立WebSocket连接
+    if cached_token is not None and await asyncio.to_thread(os.path.exists, integration_file):
+        logging.info("Cached token and mcp_server integration found, skip setup")
+        return cached_token
 
     # 获取访问令牌（从缓存或认证）
-    token_info = _get_access_token(token_file)
+    token_info = _get_access_token(cached_token)
 
     # 构建WebSocket URL
     home_assistant_ws = _build_websocket_url(home_assistant_url)
@@ -55,10 +80,12 @@ async def get_or_create_long_token():
             auto_reconnect=False
         ) as cli:
             # 获取或创建MCP令牌
-            mcp_token = await _get_or_create_mcp_token(cli, token_file)
+            mcp_token = await _get_or_create_mcp_token(cli, token_file, cached_token)
 
             # 设置MCP集成（如果需要）
-            await _setup_mcp_integration_if_needed(cli, mcp_token)
+            if await _setup_mcp_integration_if_needed(cli, mcp_token):
+                async with aiofiles.open(integration_file, "w") as f:
+                    await f.write("ok")
 
             if "refresh_token" in token_info:
                 refresh_token = token_info["refresh_token"]
@@ -69,25 +96,41 @@ async def get_or_create_long_token():
             return mcp_token
     except HAAuthError as e:
         logging.error(f"Home Assistant authentication error: {e}")
-        if os.path.exists(token_file):
-            os.remove(token_file)
+        for cache_file in (token_file, integration_file):
+            if await asyncio.to_thread(os.path.exists, cache_file):
+                await asyncio.to_thread(os.remove, cache_file)
         raise
 
 
-def _get_access_token(token_file: str) -> dict:
+async def _read_cached_token(token_file: str) -> Optional[str]:
     """
-    从缓存文件获取访问令牌，如果不存在则通过认证获取。
+    从缓存文件读取令牌。
 
     Args:
         token_file: 令牌文件路径
 
+    Returns:
+        Optional[str]: 缓存的令牌，文件不存在时返回None
+    """
+    if not await asyncio.to_thread(os.path.exists, token_file):
+        return None
+    async with aiofiles.open(token_file, "r") as f:
+        line = await f.readline()
+        return line.strip()
+
+
+def _get_access_token(cached_token: Optional[str]) -> dict:
+    """
+    使用缓存的令牌作为访问令牌，如果没有则通过认证获取。
+
+    Args:
+        cached_token: 缓存的令牌，没有缓存时为None
+
     Returns:
         dict: 包含access_token的字典
     """
-    if os.path.exists(token_file):
-        # 从缓存文件读取令牌
-        with open(token_file, "r") as f:
-            return {"access_token": f.readline().strip()}
+    if cached_token is not None:
+        return {"access_token": cached_token}
     else:
         # 通过认证获取新令牌
         auth = HomeAssistantAuth(
@@ -126,27 +169,28 @@ def _build_websocket_url(base_url: str) -> str:
     Returns:
         str: WebSocket URL
     """
-    if base_url.startswith("https"):
-        return base_url.replace("https://", "wss://")
-    else:
-        return base_url.replace("http://", "ws://")
+    if base_url.startswith("https://"):
+        return "wss://" + base_url[8:]
+    if base_url.startswith("http://"):
+        return "ws://" + base_url[7:]
+    return base_url
 
 
-async def _get_or_create_mcp_token(cli: HAWebSocketClient, token_file: str) -> str:
+async def _get_or_create_mcp_token(cli: HAWebSocketClient, token_file: str, cached_token: Optional[str]) -> str:
     """
     获取或创建MCP长期访问令牌。
 
     Args:
         cli: WebSocket客户端实例
         token_file: 令牌文件路径
+        cached_token: 缓存的MCP令牌，没有缓存时为None
 
     Returns:
         str: MCP令牌
     """
-    if os.path.exists(token_file):
-        # 从文件读取现有MCP令牌
-        with open(token_file, "r") as f:
-            return f.readline().strip()
+    if cached_token is not None:
+        # 复用已读取的MCP令牌
+        return cached_token
     else:
         # 删除现有的MCP令牌（如果存在）
         await _delete_existing_mcp_tokens(cli)
@@ -156,8 +200,8 @@ async def _get_or_create_mcp_token(cli: HAWebSocketClient, token_file: str) -> s
         mcp_token = await cli.create_long_lived_token(client_name="mcp")
 
         # 保存令牌到文件
-        with open(token_file, "w") as f:
-            f.write(mcp_token)
+        async with aiofiles.open(token_file, "w") as f:
+            await f.write(mcp_token)
 
         return mcp_token
 
@@ -185,17 +229,24 @@ async def _delete_existing_mcp_tokens(cli: HAWebSocketClient) -> None:
                 await cli.delete_refresh_token(token_id)
 
 
-async def _setup_mcp_integration_if_needed(cli: HAWebSocketClient, mcp_token: str) -> None:
+async def _setup_mcp_integration_if_needed(cli: HAWebSocketClient, mcp_token: str) -> bool:
     """
     检查并设置MCP集成（如果尚未设置）。
 
     Args:
         cli: WebSocket客户端实例
         mcp_token: MCP访问令牌
+
+    Returns:
+        bool: 集成已存在或创建成功返回True，状态未知或创建失败返回False
     """
     # 检查是否已存在MCP服务器集成
     have_mcp_server = await _check_mcp_server_integration(cli)
 
+    if have_mcp_server is None:
+        # 无法确认集成状态时不创建，避免产生重复集成
+        logging.warning("Unable to determine mcp_server integration state, skip setup")
+        return False
     if not have_mcp_server:
         # 创建MCP集成
         api_client = HomeAssistantIntegrationFlow(base_url=home_assistant_url, token=mcp_token)
@@ -204,9 +255,13 @@ async def _setup_mcp_integration_if_needed(cli: HAWebSocketClient, mcp_token: st
         logging.info("Create a new MCP integration")
         result = mcp.setup_integration()
         logging.info(f"MCP integration setup result: {result}")
+        if not result:
+            logging.error("MCP integration setup failed")
+            return False
+    return True
 
 
-async def _check_mcp_server_integration(cli: HAWebSocketClient) -> bool:
+async def _check_mcp_server_integration(cli: HAWebSocketClient) -> Optional[bool]:
     """
     检查是否已存在MCP服务器集成。
 
@@ -214,9 +269,12 @@ async def _check_mcp_server_integration(cli: HAWebSocketClient) -> bool:
         cli: WebSocket客户端实例
 
     Returns:
-        bool: 如果存在MCP服务器集成则返回True，否则返回False
+        Optional[bool]: 如果存在MCP服务器集成则返回True，不存在返回False，
+        在超时时间内未收到配置条目（状态未知）时返回None
     """
     have_mcp_server = False
+    # 订阅后首次回调携带当前所有配置条目，收到后才能得出结论
+    entries_received = asyncio.Event()
 
     async def on_config_changed(event):
         nonlocal have_mcp_server
@@ -228,14 +286,49 @@ async def _check_mcp_server_integration(cli: HAWebSocketClient) -> bool:
                     have_mcp_server = True
                     logging.info("Found mcp_server integration, skip setup")
                     break
+        entries_received.set()
 
     # 订阅配置条目变更
     await cli.subscribe_config_entries(on_config_changed, type_filter=["device", "hub", "service", "hardware"])
 
+    try:
+        await asyncio.wait_for(entries_received.wait(), timeout=CONFIG_ENTRIES_TIMEOUT)
+    except asyncio.TimeoutError:
+        logging.warning(f"No config entries received within {CONFIG_ENTRIES_TIMEOUT}s")
+        return None
+
     return have_mcp_server
 
+def clear_cached_token() -> None:
+    """
+    删除缓存的令牌文件和MCP集成标记文件，并清空内存中的令牌缓存。
+
+    当Home Assistant拒绝缓存的令牌（例如令牌已被撤销）时调用，下次启动将重新创建令牌并检查集成。
+    """
+    _token_cache.clear()
+    for name in (TOKEN_FILE_NAME, INTEGRATION_FILE_NAME):
+        cache_file = os.path.join(home_assistant_cache_dir, name)
+        if os.path.exists(cache_file):
+            logging.info(f"Remove cached file: {cache_file}")
+            os.remove(cache_file)
+
+
 def get_or_create_long_token_sync():
-    return asyncio.run(get_or_create_long_token())
+    """
+    同步获取MCP长期访问令牌，结果按(URL, 用户名)在内存中缓存TOKEN_CACHE_TTL秒。
+
+    Returns:
+        str: MCP长期访问令牌
+    """
+    key = (home_assistant_url, home_assistant_username)
+    cached = _token_cache.get(key)
+    if cached is not None and time.monotonic() - cached[1] < TOKEN_CACHE_TTL:
+        logging.debug("Using in-memory cached long-lived token")
+        return cached[0]
+
+    token = asyncio.run(get_or_create_long_token())
+    _token_cache[key] = (token, time.monotonic())
+    return token
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
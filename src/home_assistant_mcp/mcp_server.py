@@ -1,26 +1,88 @@
-import json
+import asyncio
+import copy
+import functools
 import hashlib
+import time
+import orjson
 import yaml
-from typing import Any, Optional, Dict, List
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional, Dict, List, Tuple
 
+import anyio
+import httpx
 from fastmcp import Client, FastMCP
 from fastmcp.exceptions import ToolError
-from mcp.types import TextContent
+from mcp.shared.exceptions import McpError
+from mcp.types import CONNECTION_CLOSED, TextContent
 import logging
+
+try:
+    from yaml import CSafeLoader
+except ImportError:  # PyYAML built without libyaml
+    from yaml import SafeLoader as CSafeLoader
+
 logger = logging.getLogger(__name__)
 
 # --- Constants ---
 CONTEXT_PREFIX = "Live Context: An overview of the areas and the devices in this smart home:"
+# Seconds a processed context stays valid before GetLiveContext is called again
+CONTEXT_CACHE_TTL = 30.0
+# Errors meaning the upstream session is gone and has to be reopened
+CONNECTION_ERRORS = (
+    ConnectionError,
+    httpx.TransportError,
+    anyio.ClosedResourceError,
+    anyio.BrokenResourceError,
+    anyio.EndOfStream,
+    RuntimeError,  # raised by fastmcp when the client is not connected
+)
+
+
+def _is_auth_error(error: BaseException) -> bool:
+    """Returns True if the error (or one it wraps) is an HTTP 401 from Home Assistant."""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code == 401
+    if isinstance(error, BaseExceptionGroup):
+        return any(_is_auth_error(e) for e in error.exceptions)
+    cause = error.__cause__ or error.__context__
+    return cause is not None and _is_auth_error(cause)
+
+
+@functools.cache
+def _read_config_file(path: str) -> Dict[str, Any]:
+    """Parses a JSON configuration file once per path."""
+    with open(path, "rb") as f:
+        data = orjson.loads(f.read())
+    logger.info(f"Loaded configuration from {path}")
+    return data
+
+
+def _load_config_file(path: str) -> Dict[str, Any]:
+    """Returns a private copy of the cached configuration so instances cannot affect each other."""
+    return copy.deepcopy(_read_config_file(path))
 
-class HomeAssistantController:
-    """A controller to interact with the Home Assistant MCP server."""
 
-    def __init__(self, config: str | Dict[str, Any] = "config.json"):
+class HomeAssistantController:
+    """
+    A controller to interact with the Home Assistant MCP server.
+
+    Use it as an async context manager: the MCP client session is opened on
+    entry and reused by every call until exit. If the session is lost (or could
+    not be opened on entry), the next call reconnects once and retries.
+    """
+
+    def __init__(
+        self,
+        config: str | Dict[str, Any] = "config.json",
+        on_auth_error: Optional[Callable[[], None]] = None,
+    ):
         """
         Initializes the controller by loading config and creating a client.
 
         Args:
             config: Path to the JSON configuration file or a dictionary configuration object.
+            on_auth_error: Called when Home Assistant rejects the token while connecting,
+                e.g. to drop a cached token that has been revoked.
         """
         logger.info("Initializing HomeAssistantController")
         self.config: Dict[str, Any] = self._load_config(config)
@@ -28,6 +90,67 @@ class HomeAssistantController:
         logger.info("HomeAssistantController initialized")
         self._context: Optional[List[Dict[str, Any]]] = None
         self._context_hash: Optional[str] = None
+        self._context_fetched_at: float = 0.0
+        self._context_index: Dict[str, Dict[str, Any]] = {}
+        self._connected: bool = False
+        # Bumped on every successful connect so concurrent callers reconnect only once
+        self._connection_generation: int = 0
+        self._reconnect_lock = asyncio.Lock()
+        self._on_auth_error = on_auth_error
+
+    async def __aenter__(self) -> "HomeAssistantController":
+        """Opens the MCP client session shared by all subsequent calls."""
+        try:
+            await self._connect()
+        except Exception as e:
+            logger.warning(f"Could not connect to Home Assistant MCP server, will retry on next call: {e}")
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        """Closes the shared MCP client session."""
+        if self._connected:
+            logger.info("Disconnecting from Home Assistant MCP server")
+            self._connected = False
+            await self.client.__aexit__(exc_type, exc_value, traceback)
+
+    async def _connect(self) -> None:
+        """Enters the MCP client context."""
+        logger.info("Connecting to Home Assistant MCP server")
+        try:
+            await self.client.__aenter__()
+        except Exception as e:
+            if self._on_auth_error is not None and _is_auth_error(e):
+                logger.error("Home Assistant rejected the MCP token")
+                self._on_auth_error()
+            raise
+        self._connected = True
+        self._connection_generation += 1
+
+    async def _reconnect(self, generation: int) -> None:
+        """Reopens the MCP client session unless another call already did since `generation`."""
+        async with self._reconnect_lock:
+            if generation != self._connection_generation:
+                return
+            if self._connected:
+                self._connected = False
+                try:
+                    await self.client.__aexit__(None, None, None)
+                except Exception as e:
+                    logger.debug(f"Error closing stale MCP client session: {e}")
+            await self._connect()
+
+    async def _call_tool(self, name: str, arguments: Optional[Dict[str, Any]] = None) -> Any:
+        """Calls an upstream tool on the shared session, reconnecting once on a connection error."""
+        generation = self._connection_generation
+        try:
+            return await self.client.call_tool(name=name, arguments=arguments)
+        except Exception as e:
+            connection_closed = isinstance(e, McpError) and e.error.code == CONNECTION_CLOSED
+            if not connection_closed and not isinstance(e, CONNECTION_ERRORS):
+                raise
+            logger.warning(f"Connection to Home Assistant lost during {name}, reconnecting: {e}")
+        await self._reconnect(generation)
+        return await self.client.call_tool(name=name, arguments=arguments)
 
     def _load_config(self, config: str | Dict[str, Any]) -> Dict[str, Any]:
         """Loads configuration from a JSON file or returns the config dictionary."""
@@ -37,50 +160,51 @@ class HomeAssistantController:
 
         # If it's not a dict, treat it as a file path
         try:
-            with open(config, "r") as f:
-                data = json.load(f)
-                logger.info(f"Loaded configuration from {config}")
-                return data
+            return _load_config_file(config)
         except FileNotFoundError:
             logger.error(f"Configuration file not found at: {config}")
             raise ToolError(f"Configuration file not found at: {config}")
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             logger.error(f"Error parsing JSON configuration: {e}")
             raise ToolError(f"Error parsing JSON configuration: {e}")
 
-    async def _get_raw_context(self) -> str:
-        """Fetches the raw context string from the Home Assistant server."""
-        async with self.client:
-            logger.debug("Requesting live context from Home Assistant")
-            context_response = await self.client.call_tool("GetLiveContext")
-            if not context_response.content or not isinstance(context_response.content[0], TextContent):
-                logger.error("Received an empty or invalid response from GetLiveContext")
-                raise ToolError("Received an empty or invalid response from GetLiveContext.")
-
-            # Use type assertion for TextContent
-            text_content: TextContent = context_response.content[0]
-            context_json: Dict[str, Any] = json.loads(text_content.text)
-            if not context_json.get("success"):
-                logger.error("API call to GetLiveContext failed")
-                raise ToolError(f"API call to GetLiveContext failed: {context_json.get('result')}")
-
-            result_str: str = context_json.get("result", "")
-            logger.debug(f"Live context string length: {len(result_str)}")
-            return result_str.replace(CONTEXT_PREFIX, "").strip()
+    async def _get_raw_context(self) -> bytes:
+        """Fetches the raw context from the Home Assistant server as UTF-8 bytes. Uses the shared session."""
+        logger.debug("Requesting live context from Home Assistant")
+        context_response = await self._call_tool("GetLiveContext")
+        if not context_response.content or not isinstance(context_response.content[0], TextContent):
+            logger.error("Received an empty or invalid response from GetLiveContext")
+            raise ToolError("Received an empty or invalid response from GetLiveContext.")
+
+        # Use type assertion for TextContent
+        text_content: TextContent = context_response.content[0]
+        context_json: Dict[str, Any] = orjson.loads(text_content.text)
+        if not context_json.get("success"):
+            logger.error("API call to GetLiveContext failed")
+            raise ToolError(f"API call to GetLiveContext failed: {context_json.get('result')}")
+
+        result_str: str = context_json.get("result", "")
+        logger.debug(f"Live context string length: {len(result_str)}")
+        # Encode once; the bytes are used both for the cache hash and for parsing
+        return result_str.removeprefix(CONTEXT_PREFIX).strip().encode("utf-8")
 
     def _process_context(self, context_list: List[Dict[str, Any]]) -> None:
-        """Adds a unique MD5 hash ID to each device in the context list."""
+        """Adds a unique BLAKE2b hash ID to each device and indexes the devices by ID."""
+        self._context_index = {}
         for item in context_list:
             names: str = item.get("names", "")
-            item["id"] = hashlib.md5(names.encode("utf-8")).hexdigest()
+            item["id"] = hashlib.blake2b(names.encode("utf-8"), digest_size=16).hexdigest()
+            # Devices sharing a name share an id; keep the first one, as the old linear scan did
+            self._context_index.setdefault(item["id"], item)
         logger.debug(f"Processed context devices: {len(context_list)}")
 
     async def get_processed_context(self, force_refresh: bool = False) -> List[Dict[str, Any]]:
         """
         Retrieves and processes the device context from Home Assistant.
 
-        Caches the context to avoid redundant API calls. The cache is
-        invalidated if the raw context from the server has changed.
+        Caches the context to avoid redundant API calls. A cached context younger
+        than CONTEXT_CACHE_TTL is returned without contacting the server; after
+        that the raw context is fetched again and only re-parsed if it changed.
 
         Args:
             force_refresh: If True, forces a refresh of the context from the server.
@@ -88,14 +212,25 @@ class HomeAssistantController:
         Returns:
             A list of dictionaries, each representing a device with a unique 'id'.
         """
-        raw_context_str: str = await self._get_raw_context()
-        new_hash: str = hashlib.md5(raw_context_str.encode("utf-8")).hexdigest()
-
-        if force_refresh or self._context is None or self._context_hash != new_hash:
+        if (
+            not force_refresh
+            and self._context is not None
+            and time.monotonic() - self._context_fetched_at < CONTEXT_CACHE_TTL
+        ):
+            logger.debug("Returning processed context from cache (within TTL)")
+            return self._context
+
+        raw_context: bytes = await self._get_raw_context()
+        new_hash: str = hashlib.blake2b(raw_context, digest_size=16).hexdigest()
+
+        if self._context is None or self._context_hash != new_hash:
             try:
-                # The context from Home Assistant is still in YAML format, so we use yaml.safe_load here.
-                # If the API also returns JSON, you can change this to json.loads().
-                context_list: Any = yaml.safe_load(raw_context_str)
+                # The context from Home Assistant is usually YAML. Try the much faster JSON parser
+                # first in case the API returns JSON, then fall back to the libyaml-backed loader.
+                try:
+                    context_list: Any = orjson.loads(raw_context)
+                except orjson.JSONDecodeError:
+                    context_list = yaml.load(raw_context, Loader=CSafeLoader)
                 if not isinstance(context_list, list):
                      raise ToolError("Parsed context from Home Assistant is not a list.")
                 self._process_context(context_list)
@@ -105,6 +240,7 @@ class HomeAssistantController:
             except yaml.YAMLError as e:
                 logger.error(f"Error parsing YAML from context: {e}")
                 raise ToolError(f"Error parsing YAML from context: {e}")
+        self._context_fetched_at = time.monotonic()
 
         if self._context is None:
             logger.error("Context is None after processing")
@@ -114,17 +250,16 @@ class HomeAssistantController:
         return self._context
 
     async def _hass_turn(self, names: str, areas: str, on: bool) -> Dict[str, Any]:
-        """Helper function to turn a device on or off via MCP tool call."""
+        """Helper function to turn a device on or off via MCP tool call. Uses the shared session."""
         tool_name = "HassTurnOn" if on else "HassTurnOff"
         arguments = {"name": names, "area": areas}
-        async with self.client:
-            logger.info(f"Calling {tool_name} for name={names}, area={areas}")
-            result = await self.client.call_tool(name=tool_name, arguments=arguments)
-            if not result.content or not isinstance(result.content[0], TextContent):
-                logger.error("Response content is empty or invalid for hass turn")
-                raise ToolError("Response content is empty or invalid")
-            text_content: TextContent = result.content[0]
-            return json.loads(text_content.text)
+        logger.info(f"Calling {tool_name} for name={names}, area={areas}")
+        result = await self._call_tool(tool_name, arguments)
+        if not result.content or not isinstance(result.content[0], TextContent):
+            logger.error("Response content is empty or invalid for hass turn")
+            raise ToolError("Response content is empty or invalid")
+        text_content: TextContent = result.content[0]
+        return orjson.loads(text_content.text)
 
     async def control_switch(self, device_ids: List[str], on: bool) -> List[Dict[str, Any]]:
         """
@@ -138,11 +273,16 @@ class HomeAssistantController:
             A list of dictionaries, each representing the result of an operation.
         """
         logger.info(f"Switch control request: count={len(device_ids)}, on={on}")
-        context: List[Dict[str, Any]] = await self.get_processed_context()
+        if not device_ids:
+            return []
+        await self.get_processed_context()
         results: List[Dict[str, Any]] = []
+        # (index in results, device id) for each dispatched call, in task order
+        pending: List[Tuple[int, str]] = []
+        tasks: List[Awaitable[Dict[str, Any]]] = []
 
         for device_id in device_ids:
-            target_device = next((item for item in context if item.get("id") == device_id), None)
+            target_device = self._context_index.get(device_id)
 
             if not target_device:
                 logger.warning(f"Device not found: id={device_id}")
@@ -157,29 +297,36 @@ class HomeAssistantController:
                 results.append({"success": False, "error": f"Device '{device_id}' is missing 'names' or 'areas' information."})
                 continue
 
-            try:
-                result: Dict[str, Any] = await self._hass_turn(names, areas, on)
-                results.append({"success": True, "device_id": device_id, "result": result})
-            except Exception as e:
-                logger.exception(f"Error controlling switch for id={device_id}")
-                results.append({"success": False, "device_id": device_id, "error": str(e)})
+            pending.append((len(results), device_id))
+            results.append({"success": False, "device_id": device_id})
+            tasks.append(self._hass_turn(names, areas, on))
+
+        outcomes = await asyncio.gather(*tasks, return_exceptions=True)
 
-        logger.info(f"Switch control completed: success={sum(1 for r in results if r.get('success'))}, fail={sum(1 for r in results if not r.get('success'))}")
+        success_count = 0
+        for (index, device_id), outcome in zip(pending, outcomes):
+            if isinstance(outcome, BaseException):
+                logger.error(f"Error controlling switch for id={device_id}", exc_info=outcome)
+                results[index] = {"success": False, "device_id": device_id, "error": str(outcome)}
+            else:
+                results[index] = {"success": True, "device_id": device_id, "result": outcome}
+                success_count += 1
+
+        logger.info(f"Switch control completed: success={success_count}, fail={len(results) - success_count}")
         return results
 
     async def _hass_light_set(self, names: str, area: str, brightness: Optional[int] = 0) -> Dict[str, Any]:
-        """Helper function to set light brightness via MCP tool call."""
+        """Helper function to set light brightness via MCP tool call. Uses the shared session."""
         arguments: Dict[str, Any] = {"name": names, "area": area}
         arguments["brightness"] = brightness
 
-        async with self.client:
-            logger.info(f"Calling HassLightSet for name={names}, area={area}, brightness={brightness}")
-            result = await self.client.call_tool(name="HassLightSet", arguments=arguments)
-            if not result.content or not isinstance(result.content[0], TextContent):
-                logger.error("Response content is empty or invalid for light set")
-                raise ToolError("Response content is empty or invalid")
-            text_content: TextContent = result.content[0]
-            return json.loads(text_content.text)
+        logger.info(f"Calling HassLightSet for name={names}, area={area}, brightness={brightness}")
+        result = await self._call_tool("HassLightSet", arguments)
+        if not result.content or not isinstance(result.content[0], TextContent):
+            logger.error("Response content is empty or invalid for light set")
+            raise ToolError("Response content is empty or invalid")
+        text_content: TextContent = result.content[0]
+        return orjson.loads(text_content.text)
 
     async def control_light_brightness(self, device_ids: List[str], brightness: Optional[int] = 0) -> List[Dict[str, Any]]:
         """
@@ -193,11 +340,16 @@ class HomeAssistantController:
             A list of dictionaries, each representing the result of an operation.
         """
         logger.info(f"Light brightness request: count={len(device_ids)}, brightness={brightness}")
-        context: List[Dict[str, Any]] = await self.get_processed_context()
+        if not device_ids:
+            return []
+        await self.get_processed_context()
         results: List[Dict[str, Any]] = []
+        # (index in results, device id) for each dispatched call, in task order
+        pending: List[Tuple[int, str]] = []
+        tasks: List[Awaitable[Dict[str, Any]]] = []
 
         for device_id in device_ids:
-            target_device = next((item for item in context if item.get("id") == device_id), None)
+            target_device = self._context_index.get(device_id)
 
             if not target_device:
                 logger.warning(f"Light device not found: id={device_id}")
@@ -212,30 +364,49 @@ class HomeAssistantController:
                 results.append({"success": False, "error": f"Device '{device_id}' is missing 'names' or 'areas' information."})
                 continue
 
-            try:
-                result: Dict[str, Any] = await self._hass_light_set(names, areas, brightness)
-                results.append({"success": True, "device_id": device_id, "result": result})
-            except Exception as e:
-                logger.exception(f"Error setting light brightness for id={device_id}")
-                results.append({"success": False, "device_id": device_id, "error": str(e)})
+            pending.append((len(results), device_id))
+            results.append({"success": False, "device_id": device_id})
+            tasks.append(self._hass_light_set(names, areas, brightness))
+
+        outcomes = await asyncio.gather(*tasks, return_exceptions=True)
 
-        logger.info(f"Light brightness completed: success={sum(1 for r in results if r.get('success'))}, fail={sum(1 for r in results if not r.get('success'))}")
+        success_count = 0
+        for (index, device_id), outcome in zip(pending, outcomes):
+            if isinstance(outcome, BaseException):
+                logger.error(f"Error setting light brightness for id={device_id}", exc_info=outcome)
+                results[index] = {"success": False, "device_id": device_id, "error": str(outcome)}
+            else:
+                results[index] = {"success": True, "device_id": device_id, "result": outcome}
+                success_count += 1
+
+        logger.info(f"Light brightness completed: success={success_count}, fail={len(results) - success_count}")
         return results
 
 class MCPHomeAssistantServer:
     """封装 FastMCP 与 HomeAssistantController，去除全局 controller。"""
 
-    def __init__(self, config: str | Dict[str, Any] = "config.json") -> None:
+    def __init__(
+        self,
+        config: str | Dict[str, Any] = "config.json",
+        on_auth_error: Optional[Callable[[], None]] = None,
+    ) -> None:
         logger.info("Initializing MCPHomeAssistantServer")
         try:
-            self.controller = HomeAssistantController(config)
+            self.controller = HomeAssistantController(config, on_auth_error)
         except ToolError:
             logger.exception("Failed to initialize HomeAssistantController")
             raise
 
+        @asynccontextmanager
+        async def lifespan(_: FastMCP) -> AsyncIterator[None]:
+            # Keep one upstream client session open for the lifetime of the server
+            async with self.controller:
+                yield
+
         self.mcp = FastMCP(
             name="HomeAssistant",
             instructions="A tool to control devices in a Home Assistant smart home.",
+            lifespan=lifespan,
         )
 
         async def get_device_info() -> List[Dict[str, Any]]:
@@ -260,6 +431,8 @@ class MCPHomeAssistantServer:
                 id: Device ids from get_device_info.
                 on: True to turn on, False to turn off.
             """
+            if not id:
+                return []
             try:
                 logger.info("switch_control invoked")
                 return await self.controller.control_switch(device_ids=id, on=on)
@@ -275,6 +448,8 @@ class MCPHomeAssistantServer:
                 id: Device ids from get_device_info.
                 brightness: 0-100, 0 to turn off.
             """
+            if not id:
+                return []
             try:
                 logger.info("light_set invoked")
                 return await self.controller.control_light_brightness(device_ids=id, brightness=brightness)